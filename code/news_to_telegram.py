@@ -2,16 +2,23 @@ from datetime import datetime, timezone
 print("Cron triggered at UTC:", datetime.now(timezone.utc))
 
 #!/usr/bin/env python3
+import io
 import os
 import re
 import html
 import time
+import string
+import json
 import hashlib
+from array import array
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-import feedparser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
@@ -20,8 +27,12 @@ DRY_RUN = os.getenv("DRY_RUN", "0") == "1"
 MAX_ITEMS_PER_REGION = 20
 DISABLE_LINK_PREVIEW = True
 
-SEEN_FILE = "seen_hashes.txt"
-MAX_SEEN = 2000
+# Raw native-endian uint64 keys, oldest first.
+SEEN_FILE = "seen_hashes.bin"
+MAX_SEEN = 20000
+
+# Per-feed HTTP validators (ETag / Last-Modified) and body hash from the last run.
+FEED_STATE_FILE = "feed_state.json"
 
 FEEDS: Dict[str, List[str]] = {
     "Singapore": [
@@ -44,6 +55,14 @@ FEEDS: Dict[str, List[str]] = {
 }
 
 DIVIDER = "\n\n──────────\n\n"
+DIGEST_HEADER = "<b>CT Daily News Digest</b>\n<i>{today} (UTC)</i>\n\n"
+
+# Region names are fixed, so their escaped headers are built once; only the
+# item count is filled in per run.
+_REGION_HEADERS = {
+    region: f"🗞️ <b>{html.escape(region, quote=False)}</b>  <i>Top {{n}}</i>"
+    for region in FEEDS
+}
 
 UA = (
     "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
@@ -53,115 +72,322 @@ UA = (
 TIMEOUT = 20
 RETRIES = 2
 BACKOFF_SECONDS = 2
+# One worker per feed: every download (and its retry backoff) is in flight at once.
+FETCH_WORKERS = sum(len(urls) for urls in FEEDS.values())
+
+# Shared across fetch threads and Telegram sends so keep-alive connections are
+# reused per host. Only idempotent GETs are retried, never the sendMessage POST.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=max(16, FETCH_WORKERS),
+    max_retries=Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_SECONDS,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+        # A feed host's Retry-After (up to hours) would hold up the whole digest;
+        # keep the per-feed wait bounded by our own backoff.
+        respect_retry_after_header=False,
+    ),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_PUNCT_TABLE = str.maketrans("", "", string.punctuation + "‘’“”–—…")
+
+# Wire stories syndicated across feeds differ in punctuation or tracking
+# links, so near-duplicates are matched on the leading title words only.
+TITLE_KEY_WORDS = 8
 
 
 def strip_tags(text: str) -> str:
-    return re.sub(r"<[^>]+>", " ", text or "")
+    if not text or "<" not in text:
+        return text or ""
+    return _TAG_RE.sub(" ", text)
 
 
 def clean_text(text: str) -> str:
     text = strip_tags(text)
     text = html.unescape(text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    # split()/join collapses whitespace runs and trims the ends in one C pass.
+    return " ".join(text.split())
 
 
 def pick_description(entry) -> str:
-    if getattr(entry, "summary", None):
-        return clean_text(entry.summary)
-    if getattr(entry, "description", None):
-        return clean_text(entry.description)
+    # Works for both our plain-dict entries and feedparser's FeedParserDict.
+    if entry.get("summary"):
+        return clean_text(entry["summary"])
+    if entry.get("description"):
+        return clean_text(entry["description"])
     return ""
 
 
-def stable_hash(title: str, link: str) -> str:
-    h = hashlib.sha256(f"{title}|{link}".encode("utf-8")).hexdigest()
-    return h[:24]
+def stable_hash(title: str, link: str) -> int:
+    # 64-bit key: plenty for dedup at MAX_SEEN entries, and ints are cheap set members.
+    h = hashlib.blake2b(f"{title}|{link}".encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "big")
 
 
-def load_seen() -> set[str]:
+def title_key(title: str) -> int:
+    words = title.casefold().translate(_PUNCT_TABLE).split()[:TITLE_KEY_WORDS]
+    h = hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "big")
+
+
+# A dict used as an insertion-ordered set, so trimming to MAX_SEEN drops the oldest keys.
+Seen = Dict[int, None]
+
+
+def load_seen() -> Seen:
     if not os.path.exists(SEEN_FILE):
-        return set()
-    with open(SEEN_FILE, "r", encoding="utf-8") as f:
-        return set(line.strip() for line in f if line.strip())
+        return {}
+    ids = array("Q")
+    with open(SEEN_FILE, "rb") as f:
+        data = f.read()
+    # Drop a torn trailing record rather than failing the whole run.
+    ids.frombytes(data[: len(data) - len(data) % ids.itemsize])
+    return dict.fromkeys(ids)
+
 
+def save_seen(seen: Seen) -> None:
+    items = array("Q", list(seen)[-MAX_SEEN:])
+    with open(SEEN_FILE, "wb") as f:
+        items.tofile(f)
 
-def save_seen(seen: set[str]) -> None:
-    items = list(seen)[-MAX_SEEN:]
-    with open(SEEN_FILE, "w", encoding="utf-8") as f:
-        f.write("\n".join(items) + ("\n" if items else ""))
 
+def load_feed_state() -> Dict[str, dict]:
+    if not os.path.exists(FEED_STATE_FILE):
+        return {}
+    try:
+        with open(FEED_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Ignoring unreadable {FEED_STATE_FILE}: {e}")
+        return {}
 
-def fetch_feed_content(url: str) -> Optional[bytes]:
+
+def save_feed_state(state: Dict[str, dict]) -> None:
+    with open(FEED_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+
+
+def body_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def feed_validators(r: requests.Response, digest: str) -> dict:
+    return {
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "body_hash": digest,
+    }
+
+
+def fetch_feed_content(
+    url: str, cached: Optional[dict] = None
+) -> Optional[Tuple[requests.Response, str]]:
+    """Return the feed response and its body hash, or None if it failed or is
+    unchanged since `cached`."""
     headers = {
         "User-Agent": UA,
         "Accept": "application/rss+xml,application/xml;q=0.9,*/*;q=0.8",
     }
+    cached = cached or {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    # Retries and backoff are handled by the session's HTTPAdapter.
+    try:
+        r = _SESSION.get(url, headers=headers, timeout=TIMEOUT)
+        if r.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {r.status_code}")
+    except Exception as e:
+        print(f"[WARN] Giving up on feed: {url} -> {e}")
+        return None
+
+    # Validators are only stored for feeds read to the end, so every entry of
+    # an unchanged feed was already considered; skip the parse.
+    if r.status_code == 304:
+        print(f"[INFO] Feed unchanged since last run: {url}")
+        return None
+    digest = body_hash(r.content)
+    if digest == cached.get("body_hash"):
+        print(f"[INFO] Feed unchanged since last run: {url}")
+        return None
+    return r, digest
+
+
+def _child_text(item: ET.Element, ns: str, name: str) -> str:
+    el = item.find(ns + name)
+    return "".join(el.itertext()) if el is not None else ""
+
+
+def _item_link(item: ET.Element, ns: str) -> str:
+    for el in item.iterfind(ns + "link"):
+        href = el.get("href")
+        if href:
+            # Atom: <link rel="alternate" href="..."/>
+            if el.get("rel", "alternate") == "alternate":
+                return href.strip()
+        elif el.text:
+            return el.text.strip()
+    # RSS items may carry only a permalink <guid>, as feedparser also accepts.
+    guid = item.find(ns + "guid")
+    if guid is not None and guid.get("isPermaLink", "true") != "false":
+        return _child_text(item, ns, "guid").strip()
+    return ""
 
-    last_err = None
-    for attempt in range(RETRIES + 1):
-        try:
-            r = requests.get(url, headers=headers, timeout=TIMEOUT)
-            if r.status_code >= 400:
-                raise requests.HTTPError(f"HTTP {r.status_code}")
-            return r.content
-        except Exception as e:
-            last_err = e
-            print(f"[WARN] Fetch failed ({attempt+1}/{RETRIES+1}): {url} -> {e}")
-            if attempt < RETRIES:
-                time.sleep(BACKOFF_SECONDS * (attempt + 1))
-
-    print(f"[WARN] Giving up on feed: {url} -> {last_err}")
-    return None
 
+def parse_feed_entries(content: bytes) -> Iterator[dict]:
+    """Stream RSS 1.0/2.0 or Atom items, keeping only title, link and summary.
 
-def fetch_region_items(feed_urls: List[str], limit: int, seen: set[str]) -> List[dict]:
+    Items are yielded as they close, so a caller that stops early also stops
+    the XML parse.
+    """
+    for _, elem in ET.iterparse(io.BytesIO(content)):
+        tag = elem.tag
+        if tag.rpartition("}")[2] not in ("item", "entry"):
+            continue
+        # Only read children in the item's own namespace, so e.g. <media:title>
+        # never shadows the real <title>.
+        ns = tag[: tag.find("}") + 1] if tag.startswith("{") else ""
+        entry = {
+            "title": _child_text(elem, ns, "title"),
+            "link": _item_link(elem, ns),
+            "summary": (
+                _child_text(elem, ns, "description")
+                or _child_text(elem, ns, "summary")
+                or _child_text(elem, ns, "content")
+            ),
+        }
+        elem.clear()
+        yield entry
+
+
+def read_entries(url: str, content: bytes) -> Iterator[dict]:
+    yielded = 0
+    try:
+        for entry in parse_feed_entries(content):
+            yielded += 1
+            yield entry
+        if yielded:
+            return
+    except ET.ParseError as e:
+        print(f"[WARN] Fast parse failed, using feedparser: {url} -> {e}")
+
+    # Imported lazily: feedparser is only the fallback and is slow to import.
+    import feedparser
+
+    d = feedparser.parse(content)
+
+    if getattr(d, "bozo", False):
+        err = getattr(d, "bozo_exception", "unknown error")
+        print(f"[WARN] Parse issue: {url} -> {err}")
+
+    # Resume after the items the fast parser already handed out.
+    yield from getattr(d, "entries", [])[yielded:]
+
+
+PendingFeeds = Dict[str, "Future[Optional[Tuple[requests.Response, str]]]"]
+
+
+def prefetch_feeds(urls: Iterable[str], feed_state: Optional[Dict[str, dict]] = None) -> PendingFeeds:
+    feed_state = feed_state or {}
+    return {url: _EXECUTOR.submit(fetch_feed_content, url, feed_state.get(url)) for url in urls}
+
+
+def fetch_region_items(
+    feed_urls: List[str],
+    limit: int,
+    seen: Seen,
+    feed_state: Optional[Dict[str, dict]] = None,
+    pending: Optional[PendingFeeds] = None,
+    title_keys: Optional[set[int]] = None,
+) -> List[dict]:
+    """Collect up to `limit` unseen items; `title_keys` is shared across regions in a run."""
     items: List[dict] = []
+    if title_keys is None:
+        title_keys = set()
+    if pending is None:
+        pending = prefetch_feeds(feed_urls, feed_state)
 
+    # Results are consumed in feed order so dedup and the limit stay deterministic.
     for url in feed_urls:
-        content = fetch_feed_content(url)
-        if not content:
+        fetched = pending[url].result()
+        if fetched is None:
             continue
-
-        d = feedparser.parse(content)
-
-        if getattr(d, "bozo", False):
-            err = getattr(d, "bozo_exception", "unknown error")
-            print(f"[WARN] Parse issue: {url} -> {err}")
-
-        entries = getattr(d, "entries", [])
-        if not entries:
-            print(f"[WARN] No entries returned: {url}")
-            continue
-
-        for e in entries:
-            title = clean_text(getattr(e, "title", ""))
-            link = getattr(e, "link", "")
-            if not title or not link:
+        r, digest = fetched
+
+        # Entries are parsed lazily: returning at `limit` also ends the XML parse.
+        got_entries = False
+        for e in read_entries(url, r.content):
+            got_entries = True
+            raw_title = e.get("title", "")
+            link = e.get("link", "")
+            if not raw_title or not link:
                 continue
 
-            desc = pick_description(e)
-            key = stable_hash(title, link)
+            # Key on the raw title so already-seen items (most of them on a
+            # typical day) are dropped before any cleanup work. Whitespace is
+            # normalized because feedparser strips titles and the fast parser
+            # does not; the key must not change when a feed switches parsers.
+            key = stable_hash(" ".join(raw_title.split()), link)
             if key in seen:
                 continue
+            title = clean_text(raw_title)
+            if not title:
+                continue
+            tkey = title_key(title)
+            if tkey in title_keys:
+                # Mark the dropped copy as seen too; title_keys only lasts a
+                # run, so otherwise it would be posted tomorrow.
+                seen[key] = None
+                continue
+            title_keys.add(tkey)
 
+            desc = pick_description(e)
             items.append({"title": title, "desc": desc, "link": link, "key": key})
             if len(items) >= limit:
                 return items
 
+        if not got_entries:
+            print(f"[WARN] No entries returned: {url}")
+
+        # Only feeds read to the end get their validators recorded; a feed the
+        # region filled up in (or never reached) must be fetched in full next time.
+        if feed_state is not None:
+            feed_state[url] = feed_validators(r, digest)
+
     return items[:limit]
 
 
 def chunk_message(text: str, max_len: int = 3800) -> List[str]:
+    # Walk cut indices over the original string; only the emitted parts are sliced.
     parts = []
-    while len(text) > max_len:
-        cut = text.rfind("\n", 0, max_len)
-        if cut == -1:
-            cut = max_len
-        parts.append(text[:cut].strip())
-        text = text[cut:].strip()
-    if text:
-        parts.append(text)
+    start, end = 0, len(text)
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    while True:
+        while start < end and text[start].isspace():
+            start += 1
+        if end - start <= max_len:
+            break
+        cut = text.rfind("\n", start, start + max_len)
+        if cut <= start:
+            cut = start + max_len
+        part = text[start:cut].strip()
+        if part:
+            parts.append(part)
+        start = cut
+    part = text[start:end]
+    if part:
+        parts.append(part)
     return parts
 
 
@@ -179,27 +405,50 @@ def telegram_send(text: str) -> None:
         "parse_mode": "HTML",
         "disable_web_page_preview": DISABLE_LINK_PREVIEW,
     }
-    r = requests.post(url, json=payload, timeout=30)
+    # Send raw UTF-8 rather than requests' ASCII-escaped json=, which turns
+    # every emoji and non-Latin character into 6-12 bytes of \uXXXX.
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    for attempt in range(RETRIES + 1):
+        r = _SESSION.post(
+            url,
+            data=data,
+            headers={"Content-Type": "application/json; charset=utf-8"},
+            timeout=30,
+        )
+        # A 429 means the message was not accepted, so waiting the advertised
+        # retry_after and resending cannot duplicate it.
+        if r.status_code != 429 or attempt == RETRIES:
+            break
+        try:
+            retry_after = r.json().get("parameters", {}).get("retry_after", BACKOFF_SECONDS)
+        except ValueError:
+            retry_after = BACKOFF_SECONDS
+        print(f"[WARN] Telegram rate limited, retrying in {retry_after}s")
+        time.sleep(retry_after)
     if r.status_code != 200:
         raise RuntimeError(f"Telegram API error {r.status_code}: {r.text}")
     r.raise_for_status()
 
 
-def format_region(region: str, items: List[dict]) -> str:
-    lines = [f"🗞️ <b>{html.escape(region)}</b>  <i>Top {len(items)}</i>"]
+def escape_text(text: str) -> str:
+    # Telegram HTML only needs &, < and > escaped outside attributes.
+    return html.escape(text, quote=False)
+
+
+def write_region(buf: io.StringIO, region: str, items: List[dict]) -> None:
+    write = buf.write
+    write(_REGION_HEADERS[region].format(n=len(items)))
     for i, it in enumerate(items, 1):
-        title = html.escape(it["title"])
-        link = it["link"]
-        desc = clean_text(it.get("desc", ""))
+        title = escape_text(it["title"])
+        link = html.escape(it["link"])
+        write(f'\n{i}. <a href="{link}">{title}</a>')
 
+        # Already cleaned by pick_description.
+        desc = it.get("desc", "")
         if desc:
             if len(desc) > 140:
                 desc = desc[:137].rstrip() + "..."
-            desc = html.escape(desc)
-            lines.append(f'{i}. <a href="{link}">{title}</a>\n   {desc}')
-        else:
-            lines.append(f'{i}. <a href="{link}">{title}</a>')
-    return "\n".join(lines)
+            write(f"\n   {escape_text(desc)}")
 
 
 def main() -> None:
@@ -207,25 +456,36 @@ def main() -> None:
         raise SystemExit("Missing BOT_TOKEN or CHAT_ID environment variables.")
 
     seen = load_seen()
+    feed_state = load_feed_state()
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-    blocks: List[str] = []
-    for region, urls in FEEDS.items():
-        region_items = fetch_region_items(urls, MAX_ITEMS_PER_REGION, seen)
+    # Kick off every feed download up front; regions are then filtered in order.
+    pending = prefetch_feeds((url for urls in FEEDS.values() for url in urls), feed_state)
+
+    title_keys: set[int] = set()
+    buf = io.StringIO()
+    buf.write(DIGEST_HEADER.format(today=today))
+    for n, (region, urls) in enumerate(FEEDS.items()):
+        region_items = fetch_region_items(
+            urls, MAX_ITEMS_PER_REGION, seen, feed_state, pending, title_keys
+        )
         if len(region_items) == 0:
             print(f"[WARN] Region returned 0 items: {region}. Feeds may be blocked/down.")
 
         for it in region_items:
-            seen.add(it["key"])
-
-        blocks.append(format_region(region, region_items))
+            seen[it["key"]] = None
 
-    msg = f"<b>CT Daily News Digest</b>\n<i>{today} (UTC)</i>\n\n" + DIVIDER.join(blocks)
+        if n:
+            buf.write(DIVIDER)
+        write_region(buf, region, region_items)
 
-    for part in chunk_message(msg):
+    # Sent one at a time on purpose: parallel sendMessage calls can land out of
+    # order, and a digest has only a handful of parts.
+    for part in chunk_message(buf.getvalue()):
         telegram_send(part)
 
     save_seen(seen)
+    save_feed_state(feed_state)
 
 
 if __name__ == "__main__":